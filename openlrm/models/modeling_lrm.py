@@ -13,6 +13,8 @@
 # limitations under the License.
 
 
+from contextlib import nullcontext
+from functools import partial
 import torch
 import torch.nn as nn
 from accelerate.logging import get_logger
@@ -36,8 +38,9 @@ class ModelLRM(nn.Module):
                  triplane_low_res: int, triplane_high_res: int, triplane_dim: int,
                  encoder_freeze: bool = True, encoder_type: str = 'dino',
                  encoder_model_name: str = 'facebook/dino-vitb16', encoder_feat_dim: int = 768,
-                 model_lora_rank: int = 0, conv_fuse=False,
-                 swin_ca_fuse=False, ca_dim=32, ca_depth=2, ca_num_heads=8, ca_window_size=2):
+                 model_lora_rank: int = 0, conv_fuse=False, conv_fuse_norm: str = 'layer',
+                 swin_ca_fuse=False, ca_dim=32, ca_depth=2, ca_num_heads=8, ca_window_size=2,
+                 use_cuda_graphs: bool = False, planes_bf16_autocast: bool = True):
         super().__init__()
         
         # attributes
@@ -50,6 +53,13 @@ class ModelLRM(nn.Module):
         self.conv_fuse = conv_fuse
         self.swin_ca_fuse = swin_ca_fuse
 
+        # bf16 autocast for encoder and transformer when the caller has none, see `_planes_autocast`
+        self.planes_bf16_autocast = planes_bf16_autocast
+
+        # captured inference graphs keyed by input shapes, see `forward_triplanes_graphed`
+        self.use_cuda_graphs = use_cuda_graphs
+        self._cuda_graphs = {}
+
         # modules
         self.encoder = self._encoder_fn(encoder_type)(
             model_name=encoder_model_name,
@@ -74,24 +84,45 @@ class ModelLRM(nn.Module):
                 num_layers=transformer_layers, num_heads=transformer_heads,
                 inner_dim=transformer_dim, cond_dim=encoder_feat_dim, mod_dim=camera_embed_dim,
             )
-        self.upsampler = nn.ConvTranspose2d(transformer_dim, triplane_dim, kernel_size=2, stride=2, padding=0)
+        # equivalent to ConvTranspose2d(kernel_size=2, stride=2) as a 1x1 conv followed by pixel shuffle
+        self.upsampler = nn.Sequential(
+            nn.Conv2d(transformer_dim, triplane_dim*4, kernel_size=1),
+            nn.PixelShuffle(2),
+        )
+        self._register_load_state_dict_pre_hook(self._convert_transposed_upsampler)
         self.synthesizer = TriplaneSynthesizer(
             triplane_dim=triplane_dim, samples_per_ray=rendering_samples_per_ray,
         )
+        # flattened spatial indices that mirror the back planes onto the front view
+        # XY plane flips both axes, XZ plane flips width, YZ plane flips height
+        plane_res = triplane_low_res * 2
+        rows = torch.arange(plane_res).view(-1, 1)
+        cols = torch.arange(plane_res).view(1, -1)
+        rev_rows, rev_cols = plane_res - 1 - rows, plane_res - 1 - cols
+        back_flip_index = torch.stack([
+            rev_rows * plane_res + rev_cols,
+            rows * plane_res + rev_cols,
+            rev_rows * plane_res + cols,
+        ], dim=0).view(1, 3, 1, plane_res**2)
+        self.register_buffer('back_flip_index', back_flip_index, persistent=False)
 
         if model_lora_rank > 0:
             if self.conv_fuse:
                 # self.front_back_conv = nn.Conv2d(in_channels=triplane_dim*2, out_channels=triplane_dim, kernel_size=(3, 3), stride=(1, 1), padding=1)
                 # zero_module(self.front_back_conv)
-                self.front_back_conv = nn.ModuleList([
+                norm_fn = self._conv_fuse_norm_fn(conv_fuse_norm, triplane_dim*4, triplane_high_res)
+                self.front_back_conv = nn.Sequential(
                         nn.Conv2d(in_channels=triplane_dim*2, out_channels=triplane_dim*4, kernel_size=(3, 3), stride=(1, 1), padding=1),
-                        nn.LayerNorm([triplane_dim*4, triplane_high_res, triplane_high_res]),  # Using Layer Normalization
+                        norm_fn(),
                         nn.GELU(),  # Using GELU activation
                         nn.Conv2d(in_channels=triplane_dim*4, out_channels=triplane_dim*4, kernel_size=(3, 3), stride=(1, 1), padding=1),
-                        nn.LayerNorm([triplane_dim*4, triplane_high_res, triplane_high_res]),  # Using Layer Normalization
+                        norm_fn(),
                         nn.GELU(),  # Using GELU activation
                         nn.Conv2d(in_channels=triplane_dim*4, out_channels=triplane_dim, kernel_size=(3, 3), stride=(1, 1), padding=1)
-                    ])
+                    )
+                # NHWC convs are faster on tensor cores, but LayerNorm over [C, H, W] would force NCHW copies
+                self.conv_fuse_memory_format = torch.channels_last if conv_fuse_norm.lower() == 'group' else torch.contiguous_format
+                self.front_back_conv = self.front_back_conv.to(memory_format=self.conv_fuse_memory_format)
                 self.freeze_modules(encoder=True, camera_embedder=True, 
                                         pos_embed=False, transformer=False, upsampler=False,
                                         synthesizer=False) 
@@ -104,6 +135,11 @@ class ModelLRM(nn.Module):
                 raise ValueError("You need to specify a method for fusing the front and the back.")
 
 
+    def _apply(self, fn, *args, **kwargs):
+        # captured graphs hold pointers into the old parameter storage, drop them on .to()/.cuda()/.half()
+        self._cuda_graphs = {}
+        return super()._apply(fn, *args, **kwargs)
+
     def freeze_modules(self, encoder=False, camera_embedder=False, 
                         pos_embed=False, transformer=False, upsampler=False, 
                         synthesizer=False):
@@ -111,23 +147,49 @@ class ModelLRM(nn.Module):
         Freeze specified modules
         """
         if encoder:
-            for param in self.encoder.parameters():
-                param.requires_grad = False
+            self._freeze(self.encoder)
         if camera_embedder:
-            for param in self.camera_embedder.parameters():
-                param.requires_grad = False
+            self._freeze(self.camera_embedder)
         if pos_embed:
-            for param in self.pos_embed.parameters():
-                param.requires_grad = False
+            self._freeze(self.pos_embed)
         if transformer:
-            for param in self.transformer.parameters():
-                param.requires_grad = False
+            self._freeze(self.transformer)
         if upsampler:
-            for param in self.upsampler.parameters():
-                param.requires_grad = False
+            self._freeze(self.upsampler)
         if synthesizer:
-            for param in self.synthesizer.parameters():
-                param.requires_grad = False
+            self._freeze(self.synthesizer)
+
+    @staticmethod
+    def _freeze(target):
+        # target is either a module or a bare parameter such as pos_embed
+        target.requires_grad_(False)
+
+    @staticmethod
+    def _convert_transposed_upsampler(state_dict, prefix, *args):
+        # checkpoints before the pixel-shuffle upsampler store a ConvTranspose2d weight of [D, D', 2, 2]
+        # output channel o*4 + i*2 + j of the 1x1 conv is shuffled to pixel (i, j) of plane channel o
+        weight_key, bias_key = f'{prefix}upsampler.weight', f'{prefix}upsampler.bias'
+        if weight_key not in state_dict:
+            return
+        weight = state_dict.pop(weight_key)
+        state_dict[f'{prefix}upsampler.0.weight'] = weight.permute(1, 2, 3, 0).reshape(-1, weight.shape[0], 1, 1)
+        if bias_key in state_dict:
+            state_dict[f'{prefix}upsampler.0.bias'] = state_dict.pop(bias_key).repeat_interleave(4)
+
+    @torch.no_grad()
+    def merge_lora(self):
+        """
+        Fold LoRA updates into the transformer weights for inference
+        """
+        # loratorch layers add B @ A into the base weights when leaving training mode
+        # and keep a merged flag, so repeated calls do not merge twice.
+        # Only the LoRA layers are put in eval mode, a later `train()` on the model unmerges them again.
+        for module in self.transformer.modules():
+            if isinstance(module, lora.LoRALayer) and module.r > 0:
+                module.eval()
+                if not getattr(module, 'merged', False):
+                    raise RuntimeError(f"{type(module).__name__}.train(False) did not merge LoRA weights, "
+                                       f"check the installed loratorch version.")
 
     @staticmethod
     def _encoder_fn(encoder_type: str):
@@ -142,11 +204,23 @@ class ModelLRM(nn.Module):
             logger.info("Using DINOv2 as the encoder")
             return Dinov2Wrapper
 
+    @staticmethod
+    def _conv_fuse_norm_fn(norm_type: str, channels: int, resolution: int):
+        norm_type = norm_type.lower()
+        assert norm_type in ['layer', 'group'], "Unsupported conv_fuse norm type"
+        if norm_type == 'layer':
+            # normalizes over [C, H, W] with per-position affine, as in the released checkpoints
+            return partial(nn.LayerNorm, [channels, resolution, resolution])
+        elif norm_type == 'group':
+            # single-group GroupNorm, resolution-agnostic and only per-channel affine
+            return partial(nn.GroupNorm, 1, channels)
+
     def forward_transformer(self, image_feats, camera_embeddings):
-        assert image_feats.shape[0] == camera_embeddings.shape[0], \
-            "Batch size mismatch for image_feats and camera_embeddings!"
-        N = image_feats.shape[0]
-        x = self.pos_embed.repeat(N, 1, 1)  # [N, L, D]
+        torch._check(image_feats.shape[0] == camera_embeddings.shape[0],
+            lambda: "Batch size mismatch for image_feats and camera_embeddings!")
+        # pass pos_embed as [1, L, D], the modulated norm of the first cond_mod block broadcasts it
+        # against the per-sample camera modulation, so its LayerNorm runs once instead of N times
+        x = self.pos_embed  # [1, L, D]
         x = self.transformer(
             x,
             cond=image_feats,
@@ -157,39 +231,109 @@ class ModelLRM(nn.Module):
     def reshape_upsample(self, tokens):
         N = tokens.shape[0]
         H = W = self.triplane_low_res
-        x = tokens.view(N, 3, H, W, -1)
-        x = torch.einsum('nihwd->indhw', x)  # [3, N, D, H, W]
-        x = x.contiguous().view(3*N, -1, H, W)  # [3*N, D, H, W]
-        x = self.upsampler(x)  # [3*N, D', H', W']
-        x = x.view(3, N, *x.shape[-3:])  # [3, N, D', H', W']
-        x = torch.einsum('indhw->nidhw', x)  # [N, 3, D', H', W']
-        x = x.contiguous()
+        # the 1x1 conv of the upsampler is a per-token linear, so apply it on the token layout
+        # directly and fold the pixel shuffle into the single permute to [N, 3, D', H', W']
+        conv, shuffle = self.upsampler
+        r = shuffle.upscale_factor
+        x = nn.functional.linear(tokens, conv.weight.flatten(1), conv.bias)  # [N, 3*H*W, D'*r*r]
+        x = x.view(N, 3, H, W, -1, r, r)  # [N, 3, H, W, D', r, r]
+        x = x.permute(0, 1, 4, 2, 5, 3, 6).reshape(N, 3, -1, H*r, W*r)  # [N, 3, D', H', W']
         return x
 
-    @torch.compile
-    def forward_planes(self, image, camera):
-        # image: [N, C_img, H_img, W_img]
+    def flip_back_planes(self, back_planes):
+        # back_planes: [N, 3, D', H', W']
+        # per-plane flips gathered in a single kernel
+        N, num_planes, channels, height, width = back_planes.shape
+        index = self.back_flip_index.expand(N, -1, channels, -1)
+        back_planes = torch.gather(back_planes.reshape(N, num_planes, channels, height*width), -1, index)
+        return back_planes.view(N, num_planes, channels, height, width)
+
+    @torch.compile(mode='reduce-overhead', dynamic=False)
+    def fuse_front_back(self, front_planes, back_planes):
+        # front_planes: [N, 3, D', H', W']
+        # back_planes: [N, 3, D', H', W'], as predicted from the back view
+        back_planes = self.flip_back_planes(back_planes)
+
+        # To fuse the front planes and the back planes
+        bs, num_planes, channels, height, width = front_planes.shape
+        if self.conv_fuse:
+            planes = torch.cat((front_planes, back_planes), dim=2)
+            planes = planes.reshape(-1, channels*2, height, width) 
+            planes = planes.contiguous(memory_format=self.conv_fuse_memory_format)
+            # Apply multiple convolutional layers
+            planes = self.front_back_conv(planes)
+            planes = planes.view(bs, num_planes, -1, height, width)
+        elif self.swin_ca_fuse:
+            # token-major views, the first op in each swin block is a LayerNorm that reads them directly
+            front_planes = front_planes.reshape(bs*num_planes, channels, height*width).permute(0, 2, 1)    # [8, 3, 32, 64, 64] -> [24, 32, 4096] -> [24, 4096, 32]
+            back_planes = back_planes.reshape(bs*num_planes, channels, height*width).permute(0, 2, 1)
+            planes = self.swin_cross_attention(front_planes, back_planes, height, width)[0].permute(0, 2, 1).reshape(bs, num_planes, channels, height, width)
+        return planes
+
+    def embed_camera(self, camera):
         # camera: [N, D_cam_raw]
+        camera_embeddings = self.camera_embedder(camera)
+        torch._check(camera_embeddings.shape[-1] == self.camera_embed_dim,
+            lambda: f"Feature dimension mismatch: {camera_embeddings.shape[-1]} vs {self.camera_embed_dim}")
+        return camera_embeddings
+
+    def _planes_autocast(self, image):
+        # run encoder and transformer in bf16 unless disabled or the caller already set up autocast,
+        # and only on devices with native bf16 (Ampere+), not the emulated path of older GPUs
+        return self.planes_bf16_autocast and image.is_cuda and not torch.is_autocast_enabled() \
+            and torch.cuda.get_device_capability(image.device)[0] >= 8
+
+    @torch.compile(mode='max-autotune', dynamic=False)
+    def _forward_planes(self, image, camera_embeddings, autocast: bool = False):
+        # image: [N, C_img, H_img, W_img]
+        # camera_embeddings: [N, D_cam]
         N = image.shape[0]
 
-        # encode image
-        image_feats = self.encoder(image)
-        assert image_feats.shape[-1] == self.encoder_feat_dim, \
-            f"Feature dimension mismatch: {image_feats.shape[-1]} vs {self.encoder_feat_dim}"
+        # never enter a disabled autocast here, that would switch off the caller's own autocast
+        with torch.autocast('cuda', dtype=torch.bfloat16) if autocast else nullcontext():
+            # encode image
+            image_feats = self.encoder(image)
+            torch._check(image_feats.shape[-1] == self.encoder_feat_dim,
+                lambda: f"Feature dimension mismatch: {image_feats.shape[-1]} vs {self.encoder_feat_dim}")
 
-        # embed camera
-        camera_embeddings = self.camera_embedder(camera)
-        assert camera_embeddings.shape[-1] == self.camera_embed_dim, \
-            f"Feature dimension mismatch: {camera_embeddings.shape[-1]} vs {self.camera_embed_dim}"
+            # transformer generating planes
+            tokens = self.forward_transformer(image_feats, camera_embeddings)
 
-        # transformer generating planes
-        tokens = self.forward_transformer(image_feats, camera_embeddings)
-        planes = self.reshape_upsample(tokens)
-        assert planes.shape[0] == N, "Batch size mismatch for planes"
-        assert planes.shape[1] == 3, "Planes should have 3 channels"
+        # planes feed the renderer, keep them in full precision
+        planes = self.reshape_upsample(tokens.float())
+        torch._check(planes.shape[0] == N, lambda: "Batch size mismatch for planes")
+        torch._check(planes.shape[1] == 3, lambda: "Planes should have 3 channels")
 
         return planes
 
+    def forward_planes(self, image, camera):
+        # image: [N, C_img, H_img, W_img]
+        # camera: [N, D_cam_raw]
+        return self._forward_planes(image, self.embed_camera(camera), autocast=self._planes_autocast(image))
+
+    def forward_planes_two_sided(self, image, image_back, camera):
+        # image, image_back: [N, C_img, H_img, W_img]
+        # camera: [N, D_cam_raw], shared by both views
+        # both views go through the encoder and transformer as one batch of 2N,
+        # while the shared camera is embedded only once
+        N = image.shape[0]
+        camera_embeddings = self.embed_camera(camera)
+        planes = self._forward_planes(
+            torch.cat([image, image_back], dim=0),
+            camera_embeddings.repeat(2, 1),
+            autocast=self._planes_autocast(image),
+        )
+        return planes[:N], planes[N:]
+
+    def forward_triplanes(self, image, source_camera, image_back=None):
+        # image, image_back: [N, C_img, H_img, W_img]
+        # source_camera: [N, D_cam_raw]
+        # returns the (fused) planes: [N, 3, D', H', W']
+        if image_back is not None:
+            front_planes, back_planes = self.forward_planes_two_sided(image, image_back, source_camera)
+            return self.fuse_front_back(front_planes, back_planes)
+        return self.forward_planes(image, source_camera)
+
     def forward(self, image, source_camera, render_cameras, render_anchors, render_resolutions, render_bg_colors, render_region_size: int,
                 image_back=None,):
         # image: [N, C_img, H_img, W_img]
@@ -199,47 +343,66 @@ class ModelLRM(nn.Module):
         # render_resolutions: [N, M, 1]
         # render_bg_colors: [N, M, 1]
         # render_region_size: int
-        assert image.shape[0] == source_camera.shape[0], "Batch size mismatch for image and source_camera"
-        assert image.shape[0] == render_cameras.shape[0], "Batch size mismatch for image and render_cameras"
-        assert image.shape[0] == render_anchors.shape[0], "Batch size mismatch for image and render_anchors"
-        assert image.shape[0] == render_bg_colors.shape[0], "Batch size mismatch for image and render_bg_colors"
+        torch._check(image.shape[0] == source_camera.shape[0], lambda: "Batch size mismatch for image and source_camera")
+        torch._check(image.shape[0] == render_cameras.shape[0], lambda: "Batch size mismatch for image and render_cameras")
+        torch._check(image.shape[0] == render_anchors.shape[0], lambda: "Batch size mismatch for image and render_anchors")
+        torch._check(image.shape[0] == render_bg_colors.shape[0], lambda: "Batch size mismatch for image and render_bg_colors")
         N, M = render_cameras.shape[:2]
 
-        if image_back is not None:
-            front_planes = self.forward_planes(image, source_camera)
-            back_planes = self.forward_planes(image_back, source_camera)
-
-            # XY Plane
-            back_planes[:, 0, :, :, :] = torch.flip(back_planes[:, 0, :, :, :], dims=[-2, -1])
-            # XZ Plane
-            back_planes[:, 1, :, :, :] = torch.flip(back_planes[:, 1, :, :, :], dims=[-1])
-            # YZ Plane
-            back_planes[:, 2, :, :, :] = torch.flip(back_planes[:, 2, :, :, :], dims=[-2])
-        
-            # To fuse the front planes and the back planes
-            bs, num_planes, channels, height, width = front_planes.shape
-            if self.conv_fuse:
-                planes = torch.cat((front_planes, back_planes), dim=2)
-                planes = planes.reshape(-1, channels*2, height, width) 
-                # Apply multiple convolutional layers
-                for layer in self.front_back_conv:
-                    planes = layer(planes)
-                
-                planes = planes.view(bs, num_planes, -1, height, width)
-                # planes = self.front_back_conv(planes).view(bs, num_planes, -1, height, width)  # only one layer.
-            elif self.swin_ca_fuse:
-                front_planes = front_planes.reshape(bs*num_planes, channels, height*width).permute(0, 2, 1).contiguous()    # [8, 3, 32, 64, 64] -> [24, 32, 4096] -> [24, 4096, 32]
-                back_planes = back_planes.reshape(bs*num_planes, channels, height*width).permute(0, 2, 1).contiguous()
-                planes = self.swin_cross_attention(front_planes, back_planes, height, width)[0].permute(0, 2, 1).reshape(bs, num_planes, channels, height, width)
-        else:
-            planes = self.forward_planes(image, source_camera)
+        planes = self.forward_triplanes(image, source_camera, image_back=image_back)
 
         # render target views
         render_results = self.synthesizer(planes, render_cameras, render_anchors, render_resolutions, render_bg_colors, render_region_size)
-        assert render_results['images_rgb'].shape[0] == N, "Batch size mismatch for render_results"
-        assert render_results['images_rgb'].shape[1] == M, "Number of rendered views should be consistent with render_cameras"
+        torch._check(render_results['images_rgb'].shape[0] == N, lambda: "Batch size mismatch for render_results")
+        torch._check(render_results['images_rgb'].shape[1] == M, lambda: "Number of rendered views should be consistent with render_cameras")
 
         return {
             'planes': planes,
             **render_results,
         }
+
+    @torch.no_grad()
+    def forward_triplanes_graphed(self, image, source_camera, image_back=None, warmup_iters: int = 3):
+        """
+        Inference-only `forward_triplanes` replayed from a CUDA graph captured once per input shape.
+        Only the shape-static plane path is captured, rendering stays eager since the importance
+        renderer syncs on the host and uses data-dependent masks.
+        Falls back to eager `forward_triplanes` unless `use_cuda_graphs` is set and inputs live on GPU.
+        """
+        if not self.use_cuda_graphs or not image.is_cuda:
+            return self.forward_triplanes(image, source_camera, image_back=image_back)
+
+        import torch._dynamo
+        if not torch._dynamo.config.disable:
+            # compiled sub-paths replay their own cudagraphs, which cannot be nested in a capture
+            raise RuntimeError("CUDA graph capture requires torch.compile to be disabled (torch._dynamo.config.disable).")
+
+        inputs = {'image': image, 'source_camera': source_camera}
+        if image_back is not None:
+            inputs['image_back'] = image_back
+        key = tuple((k, tuple(v.shape), v.dtype) for k, v in inputs.items())
+
+        if key not in self._cuda_graphs:
+            static_inputs = {k: v.clone() for k, v in inputs.items()}
+            run = lambda: self.forward_triplanes(**static_inputs)
+
+            # warm up on a side stream so lazy init and allocator state settle before capture
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(warmup_iters):
+                    run()
+            torch.cuda.current_stream().wait_stream(stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                static_planes = run()
+            self._cuda_graphs[key] = (graph, static_inputs, static_planes)
+
+        graph, static_inputs, static_planes = self._cuda_graphs[key]
+        for k, v in inputs.items():
+            static_inputs[k].copy_(v)
+        graph.replay()
+
+        # static outputs are overwritten by the next replay
+        return static_planes.clone()
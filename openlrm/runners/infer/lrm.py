@@ -178,6 +178,7 @@ class LRMInferrer(Inferrer):
                     model,
                     inferrer_ckpt_path,
                 )                
+        model.merge_lora()
         return model
     
     @staticmethod
@@ -216,33 +217,8 @@ class LRMInferrer(Inferrer):
     def infer_planes(self, image: torch.Tensor, source_cam_dist: float, back_image=None):
         N = image.shape[0]
         source_camera = self._default_source_camera(dist_to_center=source_cam_dist, batch_size=N, device=self.device)
-        front_planes = self.model.forward_planes(image, source_camera)
-        if back_image is not None:
-            back_planes = self.model.forward_planes(back_image, source_camera)
-            # XY Plane
-            back_planes[:, 0, :, :, :] = torch.flip(back_planes[:, 0, :, :, :], dims=[-2, -1])
-            # XZ Plane
-            back_planes[:, 1, :, :, :] = torch.flip(back_planes[:, 1, :, :, :], dims=[-1])
-            # YZ Plane
-            back_planes[:, 2, :, :, :] = torch.flip(back_planes[:, 2, :, :, :], dims=[-2])
-
-            # To fuse the front planes and the back planes
-            bs, num_planes, channels, height, width = front_planes.shape
-            if 'conv_fuse' in self.cfg['model']:
-                planes = torch.cat((front_planes, back_planes), dim=2)
-                planes = planes.reshape(-1, channels*2, height, width) 
-                # planes = self.model.front_back_conv(planes).view(bs, num_planes, -1, height, width)  # only one layer.
-                # Apply multiple convolutional layers
-                for layer in self.model.front_back_conv:
-                    planes = layer(planes)
-                
-                planes = planes.view(bs, num_planes, -1, height, width)
-            elif 'swin_ca_fuse' in self.cfg['model']:
-                front_planes = front_planes.reshape(bs*num_planes, channels, height*width).permute(0, 2, 1).contiguous()    # [8, 3, 32, 64, 64] -> [24, 32, 4096] -> [24, 4096, 32]
-                back_planes = back_planes.reshape(bs*num_planes, channels, height*width).permute(0, 2, 1).contiguous()
-                planes = self.model.swin_cross_attention(front_planes, back_planes, height, width)[0].permute(0, 2, 1).reshape(bs, num_planes, channels, height, width)
-        else:
-            planes = front_planes
+        # replays a captured graph when the model enables use_cuda_graphs, eager otherwise
+        planes = self.model.forward_triplanes_graphed(image, source_camera, image_back=back_image)
 
         assert N == planes.shape[0]
         return planes
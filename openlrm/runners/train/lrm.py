@@ -50,9 +50,9 @@ class LRMTrainer(Trainer):
     def _build_optimizer(self, model: nn.Module, cfg):
         decay_params, no_decay_params = [], []
 
-        # add all bias and LayerNorm params to no_decay_params
+        # add all bias and normalization params to no_decay_params
         for name, module in model.named_modules():
-            if isinstance(module, nn.LayerNorm):
+            if isinstance(module, (nn.LayerNorm, nn.GroupNorm)):
                 no_decay_params.extend([p for p in module.parameters()])
             elif hasattr(module, 'bias') and module.bias is not None:
                 no_decay_params.append(module.bias)